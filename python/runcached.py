@@ -22,147 +22,482 @@ __maintainer__ = "Pavel Vitis <pavelvitis@gmail.com"
 __license__ = "Apache License, Version 2.0"
 __status__ = "Development"
 
-import argparse
 import fcntl
+import mmap
 import os
-import random
-import signal
-import subprocess
+import select
+import stat
 import sys
 import time
-from collections.abc import Sequence, Callable
-from contextlib import suppress, contextmanager
-from hashlib import md5
-from pathlib import Path
-from shutil import copyfileobj
-from subprocess import Popen
-from typing import Iterable, Optional
-
-# Avoid importing psutil if not necessary
-if Path("/proc").is_dir():
-    pid_exists = lambda pid: Path(f"/proc/{pid}").exists()
-else:
-    from psutil import pid_exists
+from collections.abc import Sequence
+from contextlib import suppress
+from types import SimpleNamespace
+from typing import BinaryIO, Generator, Iterable, NamedTuple, Optional, Tuple, Union
+
+try:
+    # Same implementation as hashlib.blake2b, without hashlib loading OpenSSL's _hashlib on import
+    from _blake2 import blake2b
+except ImportError:
+    from hashlib import blake2b
+
+# Modules needed only to execute the command (signal, random, shutil, subprocess) are imported
+# where they are used, a cache hit does not need to pay for importing them.
 
 # Configurable parameters
 DEFAULT_CACHE_TIMEOUT_SEC: float = 20
 MAX_WAIT_PREV_SEC: int = 5
 MIN_RAND_SEC: float = 0
 MAX_RAND_SEC: float = 0
+MMAP_MIN_SIZE: int = 4096
+PIPE_READ_SIZE: int = 1 << 16
+EXIT_CODE_XATTR: bytes = b"user.runcached.rc"
+COMMAND_XATTR: bytes = b"user.runcached.cmd"
 
 os.environ['PYTHONUNBUFFERED'] = '1'
 
 
-def get_cache_dir() -> Path:
+def find_cache_dir() -> str:
+    """
+    Find the system's temporary directory the way tempfile.gettempdir() does ($TMPDIR, $TEMP, $TMP,
+    /tmp, /var/tmp, /usr/tmp, the current directory), without importing tempfile, which pulls in
+    shutil, random and re. Write access is checked with access() instead of creating a probe file.
+    """
+    candidates = [os.environ.get(name) for name in ("TMPDIR", "TEMP", "TMP")]
+    candidates += ["/tmp", "/var/tmp", "/usr/tmp"]
+    for directory in candidates:
+        if directory and os.path.isdir(directory) and os.access(directory, os.W_OK | os.X_OK):
+            return os.path.abspath(directory)
+    return os.getcwd()
+
+
+# Resolved once, cache file paths are plain strings built from it
+_CACHE_DIR: str = find_cache_dir()
+
+
+def get_cache_dir() -> str:
     """
     Return the system's caching directory.
     """
-    from tempfile import gettempdir
-    return Path(gettempdir())
+    return _CACHE_DIR
 
 
 def generate_command_hash(command: Iterable[str]) -> str:
     """
-    Generate an MD5 hash for the given command.
+    Generate a BLAKE2b hash for the given command.
+
+    Arguments are hashed one by one, each terminated by a NUL byte (which cannot appear in an argument),
+    so that the joined command line is never built and e.g. ["a b"] and ["a", "b"] hash differently.
+    Arguments are encoded as UTF-8, with undecodable command line bytes (surrogateescape) restored
+    as they were.
+    """
+    h = blake2b(digest_size=16)
+    sep = b"\x00"
+    for arg in command:
+        h.update(arg.encode("utf-8", "surrogateescape"))
+        h.update(sep)
+    return h.hexdigest()
+
+
+class CachePaths(NamedTuple):
+    """
+    Paths of the cache files of one command, built once per invocation by build_cache_paths().
+    """
+    data: str
+    exit: str
+    cmd: str
+    pid: str
+    lock: str
+
+
+def build_cache_paths(command_hash: str) -> CachePaths:
+    """
+    Build the cache file paths for the command with given hash.
+    """
+    base = f"{_CACHE_DIR}/{command_hash}"
+    return CachePaths(data=f"{base}.data", exit=f"{base}.exit", cmd=f"{base}.cmd",
+                      pid=f"{base}.pid", lock=f"{base}.lock")
+
+
+def write_exit_code(output_cache: Union[str, int], exit_file: str, return_code: int) -> None:
+    """
+    Store the command return code as an extended attribute of the output cache file (path or open descriptor).
+
+    Falls back to exit_file where extended attributes are not supported (e.g. tmpfs on older kernels).
+    The return code is the target of the exit_file symlink, so that it can be read with a single readlink().
+    """
+    try:
+        os.setxattr(output_cache, EXIT_CODE_XATTR, str(return_code).encode())
+    except (OSError, AttributeError):
+        tmp_file = f"{exit_file}.{os.getpid()}.tmp"
+        os.symlink(str(return_code), tmp_file)
+        os.replace(tmp_file, exit_file)
+
+
+def read_exit_code(output_cache: Union[str, int], exit_file: str) -> int:
+    """
+    Read the command return code stored by write_exit_code() from the output cache file (path or open descriptor).
+
+    :raises ValueError: on corrupted exit code
+    :raises IOError: if no exit code is available
     """
-    # noinspection InsecureHash
-    return md5(" ".join(command).encode("utf-8")).hexdigest()
+    try:
+        return int(os.getxattr(output_cache, EXIT_CODE_XATTR))
+    except (OSError, AttributeError):
+        return int(os.readlink(exit_file))
+
+
+def write_command(output_cache: Union[str, int], cmd_file: str, command: Sequence[str]) -> None:
+    """
+    Store the command line as an extended attribute of the output cache file (path or open descriptor),
+    to help finding the cache files of a command when diagnosing.
+
+    Falls back to cmd_file where extended attributes are not supported.
+    """
+    command_line = os.fsencode(" ".join(command))
+    try:
+        os.setxattr(output_cache, COMMAND_XATTR, command_line)
+    except (OSError, AttributeError):
+        with open(cmd_file, 'wb') as f:
+            f.write(command_line)
 
 
 class CommandCache(object):
-    def __init__(self, command:Sequence[str], cache_timeout:float):
+    def __init__(self, command:Sequence[str], cache_timeout:float, command_hash: Optional[str] = None,
+                 verbose: bool = False, paths: Optional[CachePaths] = None):
         self.cache_timeout = cache_timeout
         self.command = command
         self.cache_dir = get_cache_dir()
-        self.command_hash = generate_command_hash(command)
-        self.output_cache = Path(self.cache_dir, f"{self.command_hash}.data")
-        self.exit_file = Path(self.cache_dir, f"{self.command_hash}.exit")
-        self.cmd_file = Path(self.cache_dir, f"{self.command_hash}.cmd")
-        if not self.cmd_file.is_file():
-            with self.cmd_file.open('w') as f:
-                f.write(" ".join(self.command))
-
-    def is_valid(self, cache_timeout: Optional[float] = None):
-        if cache_timeout is None:
-            cache_timeout = self.cache_timeout
-        return self.output_cache.is_file() and time.time() - self.output_cache.stat().st_mtime <= cache_timeout
+        self.command_hash = command_hash if command_hash is not None else generate_command_hash(command)
+        self.paths = paths if paths is not None else build_cache_paths(self.command_hash)
+        self.output_cache = self.paths.data
+        self.exit_file = self.paths.exit
+        self.cmd_file = self.paths.cmd
+        self.verbose = verbose
 
     def invalidate(self):
-        self.output_cache.unlink()
+        os.unlink(self.output_cache)
 
-    def cache_result(self, f: Iterable[str]):
-        output_cache_file_encoding = "utf-8"
-        with self.output_cache.open('w', encoding=output_cache_file_encoding) as f_cache:
+    def open_output_cache(self) -> Tuple[BinaryIO, Optional[str]]:
+        """
+        Open a new, not yet visible, output cache file for writing (and reading back).
+
+        Uses an unnamed O_TMPFILE file in the cache directory where supported and where it can be
+        given a name later, a temporary file otherwise.
+
+        :return: File object and the temporary file path (None for O_TMPFILE)
+        """
+        tmp_file = f"{self.output_cache}.{os.getpid()}.tmp"
+        if hasattr(os, "O_TMPFILE") and os.path.isdir("/proc/self/fd"):
+            try:
+                fd = os.open(self.cache_dir, os.O_TMPFILE | os.O_RDWR | os.O_CLOEXEC, 0o666)
+            except OSError:
+                # Kernel or filesystem without O_TMPFILE support
+                pass
+            else:
+                # Check while the file is still empty that linkat() through /proc is allowed (it is refused
+                # e.g. with EXDEV in some sandboxes), the output would have to be copied on publishing otherwise
+                try:
+                    os.link(f"/proc/self/fd/{fd}", tmp_file)
+                except OSError:
+                    os.close(fd)
+                else:
+                    os.unlink(tmp_file)
+                    return os.fdopen(fd, 'w+b', buffering=0), None
+        return open(tmp_file, 'w+b', buffering=0), tmp_file
+
+    def finish_output_cache(self, fd: int, return_code: int) -> None:
+        """
+        Store the return code (and the command line if verbose) with the output cache file and set its
+        modification time to now.
+        """
+        write_exit_code(fd, self.exit_file, return_code)
+        if self.verbose:
+            write_command(fd, self.cmd_file, self.command)
+        # Must update the modification timestamp so that the command runtime does not add to cache expiration timeout
+        os.utime(fd)
+
+    def publish_output_cache(self, f_cache: BinaryIO, tmp_file: Optional[str], return_code: int) -> None:
+        """
+        Atomically make the complete output cache file visible under its final name,
+        readers never see a partially written cache.
+
+        Neither link() nor rename() change the file modification time, the file is touched before.
+        """
+        fd = f_cache.fileno()
+        if tmp_file is None:
+            # Give a name to the O_TMPFILE file
+            self.finish_output_cache(fd, return_code)
+            proc_fd = f"/proc/self/fd/{fd}"
+            tmp_file = f"{self.output_cache}.{os.getpid()}.tmp"
+            try:
+                try:
+                    os.link(proc_fd, self.output_cache)
+                    return
+                except FileExistsError:
+                    # Replace the previous cache through a temporary name
+                    os.link(proc_fd, tmp_file)
+            except OSError:
+                # linkat() through /proc refused although it has been allowed on open, publish a named copy instead
+                with open(tmp_file, 'wb') as f_tmp:
+                    offset = 0
+                    size = os.fstat(fd).st_size
+                    while offset < size:
+                        offset += os.sendfile(f_tmp.fileno(), fd, offset, size - offset)
+                    self.finish_output_cache(f_tmp.fileno(), return_code)
+        else:
+            self.finish_output_cache(fd, return_code)
+        os.replace(tmp_file, self.output_cache)
+
+    def cache_result(self, cache_on_error: bool = False, cache_on_abort: bool = False):
+        """
+        Execute the command, pass its output to stdout and cache it.
+
+        The result is published only if it is going to be kept: on success, on nonzero return code
+        only with cache_on_error, on ^C only with cache_on_error or cache_on_abort. Output cut short
+        by a closed stdout or by an error (e.g. command not found, disk full) is never published.
+
+        :return: Command return code
+        """
+        return_code = 1
+        publish = False
+        # Output is cached as raw bytes, exactly as the command wrote it
+        f_cache, tmp_file = self.open_output_cache()
+        with f_cache:
+            f = execute_command(self.command, f_cache.fileno())
             try:
                 while True:
-                    line = next(f)
-                    f_cache.write(line)
-                    f_cache.flush()
+                    next(f)
             except StopIteration as s:
                 return_code = s.value
+                publish = return_code == 0 or cache_on_error
                 # print(f"{return_code=}")
             except BrokenPipeError:
+                # Output cut short by a closed stdout, never cache it
                 return_code = 0
+                publish = False
                 # print(f"{return_code=}")
             except KeyboardInterrupt:
                 return_code = 0
+                publish = cache_on_error or cache_on_abort
                 # print(f"{return_code=}")
                 raise
             finally:
-                with self.exit_file.open('w') as f:
-                    f.write(str(return_code))
-
-                # Must update the modification timestamp so that the command runtime does not add to cache expiration timeout
-                self.output_cache.touch()
+                if publish:
+                    self.publish_output_cache(f_cache, tmp_file, return_code)
+                elif tmp_file is not None:
+                    with suppress(FileNotFoundError):
+                        os.unlink(tmp_file)
 
         return return_code
 
 
-def execute_command(command: Sequence[str], output_cache_file_encoding: str = "utf-8") -> Iterable[str]:
+def write_all(fd: int, data: bytes) -> None:
+    """
+    Write all data to the file descriptor, write() may be partial e.g. on pipes.
+    """
+    with memoryview(data) as view:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, view[written:])
+
+
+def close_inherited_fds_on_exec() -> bool:
+    """
+    Set close-on-exec on the descriptors above stderr that this process inherited, so that they are not
+    passed on to the command (descriptors opened by Python are non-inheritable already).
+
+    :returns: Return False if the open descriptors cannot be listed
+    """
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return False
+    for name in fds:
+        fd = int(name)
+        if fd > 2:
+            # The descriptor listdir() used is already closed
+            with suppress(OSError):
+                os.set_inheritable(fd, False)
+    return True
+
+
+def spawn_command(command: Sequence[str]) -> Tuple[int, int]:
+    """
+    Start the command with both stdout and stderr redirected into a new pipe.
+
+    Uses os.posix_spawnp(), which does not duplicate the page tables of this process like fork() does,
+    subprocess.Popen where it is not available. Like Popen (close_fds=True), the command gets only
+    stdin, stdout and stderr, none of the other descriptors inherited by this process.
+
+    :return: PID of the command and the read end of its output pipe
+    """
+    import signal
+
+    out_fd, in_fd = os.pipe()
+    try:
+        if hasattr(os, "posix_spawnp") and close_inherited_fds_on_exec():
+            pid = os.posix_spawnp(command[0], command, os.environ,
+                                  file_actions=[(os.POSIX_SPAWN_DUP2, in_fd, 1), (os.POSIX_SPAWN_DUP2, in_fd, 2)],
+                                  # Python ignores SIGPIPE and SIGXFSZ, restore their default like Popen does
+                                  setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        else:
+            from subprocess import Popen
+            pid = Popen(command, stdout=in_fd, stderr=in_fd).pid
+    except BaseException:
+        os.close(out_fd)
+        raise
+    finally:
+        os.close(in_fd)
+    return pid, out_fd
+
+
+def wait_for_exit_code(pid: int) -> int:
+    """
+    Wait for the command to finish and return its exit code, negative signal number if it was killed
+    (like Popen.returncode).
+    """
+    _, status = os.waitpid(pid, 0)
+    if hasattr(os, "waitstatus_to_exitcode"):
+        return os.waitstatus_to_exitcode(status)
+    return -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+
+def execute_command(command: Sequence[str], cache_fd: int) -> Generator[int, None, int]:
     """
     Execute a command and redirect results into cache files:
 
-        - execution return_code into exit_file
+        - execution return_code into output_cache_file extended attribute or exit_file
         - stdout & stderr into output_cache_file
+
+    Command output is written to cache_fd and passed to stdout as it comes. Where supported, the output
+    is moved from the pipe to the cache file with splice() and from there to stdout with sendfile(),
+    without copying it through Python. Otherwise it is read and written in chunks.
+
+    The generator yields the size of each chunk of output, it returns the command return code.
+    It raises BrokenPipeError if stdout gets closed before all output has been passed on, the command
+    is sent SIGPIPE then and the cached output is incomplete.
     """
+    import signal
+
     return_code = 1
     keyboard_interrupt = False
-    process = Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    while process.poll() is None:
+    broken_pipe = False
+    pid, out_fd = spawn_command(command)
+    stdout_fd = sys.stdout.fileno()
+    use_splice = hasattr(os, "splice")
+    use_sendfile = True
+    offset = 0
+    # Anything already written to sys.stdout must precede the output written to its descriptor
+    sys.stdout.flush()
+    while True:
         try:
-            if True: #process.stdout.readable():
-                # print("Reading the line from command output...", file=sys.stderr)
-                line = process.stdout.readline().decode(output_cache_file_encoding)
+            if use_splice:
                 try:
-                    process.stdout.flush()
-                    if line:
-                        print(line, end="", file=sys.stdout, flush=True)
-                except BrokenPipeError:
-                    # print("BrokenPipeError...", file=sys.stderr)
-                    devnull = os.open(os.devnull, os.O_WRONLY)
-                    os.dup2(devnull, sys.stdout.fileno())
-                    process.send_signal(signal.SIGPIPE)
-                    return_code = 0
-                    break
-                else:
-                    yield line
+                    size = os.splice(out_fd, cache_fd, PIPE_READ_SIZE)
+                except OSError:
+                    # Cache filesystem does not support splice()
+                    use_splice = False
+                    continue
             else:
+                chunk = os.read(out_fd, PIPE_READ_SIZE)
+                write_all(cache_fd, chunk)
+                size = len(chunk)
+            if not size:
+                # EOF, command finished
+                return_code = wait_for_exit_code(pid)
                 break
-                # time.sleep(.5)
+            try:
+                if use_splice and use_sendfile:
+                    # Send the chunk on to stdout from the cache file
+                    try:
+                        sent = 0
+                        while sent < size:
+                            sent += os.sendfile(stdout_fd, cache_fd, offset + sent, size - sent)
+                    except BrokenPipeError:
+                        raise
+                    except OSError:
+                        # sendfile() not supported for this stdout
+                        use_sendfile = False
+                        write_all(stdout_fd, os.pread(cache_fd, size - sent, offset + sent))
+                elif use_splice:
+                    write_all(stdout_fd, os.pread(cache_fd, size, offset))
+                else:
+                    write_all(stdout_fd, chunk)
+            except BrokenPipeError:
+                # print("BrokenPipeError...", file=sys.stderr)
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, stdout_fd)
+                os.kill(pid, signal.SIGPIPE)
+                broken_pipe = True
+                break
+            else:
+                offset += size
+                yield size
         except KeyboardInterrupt:
             return_code = 1
             keyboard_interrupt = True
             break
-    else:
-        return_code = process.returncode
+    os.close(out_fd)
 
     if keyboard_interrupt:
         raise KeyboardInterrupt()
+    elif broken_pipe:
+        raise BrokenPipeError()
     else:
         return return_code
 
 
-def wait_for_previous_command(pid_file: Path, wait_time_sec: int) -> bool:
+def pid_exists(pid: int) -> bool:
+    """
+    Check whether a process with given PID exists, by sending it the null signal.
+    """
+    if pid <= 0:
+        # Would address a process group
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process exists, but belongs to another user
+        return True
+    return True
+
+
+def wait_for_process_exit(pid: int, wait_time_sec: int) -> Optional[bool]:
+    """
+    Wait for the process with given PID to exit using a pidfd, without polling.
+
+    The pidfd becomes readable when the process terminates, so the kernel wakes us up immediately
+    instead of checking the process once per second.
+
+    :returns: Return True if the process exited, False on timeout, None if pidfd is not supported
+    """
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        # Process already finished
+        return True
+    except (OSError, AttributeError):
+        # Python < 3.9, Linux < 5.3 or other platform
+        return None
+    try:
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        return bool(poller.poll(wait_time_sec * 1000))
+    finally:
+        os.close(fd)
+
+
+def read_pid_file(pid_file: str) -> int:
+    """
+    Read the PID stored in the given pid_file.
+    """
+    with open(pid_file) as f:
+        return int(f.read())
+
+
+def wait_for_previous_command(pid_file: str, wait_time_sec: int) -> bool:
     """
     Wait for a previous instance of the command to finish by checking for the existence
     of the given pid_file.
@@ -172,37 +507,135 @@ def wait_for_previous_command(pid_file: Path, wait_time_sec: int) -> bool:
     Also handles stale pid_file by checking if the process is still running. If it's not running,
     the pid_file is removed and function returns True.
 
+    Where supported, the process from the pid_file is waited for with pidfd_open() + poll(),
+    otherwise the pid_file is checked with exponential backoff, from 1ms up to every 100ms.
+
     :returns: Return True on success, False on timeout
     """
-    if not pid_file.is_file():
+    try:
+        pid: int = read_pid_file(pid_file)
+    except FileNotFoundError:
         # PID file cleaned up, process finished
         return True
-
-    for _ in range(wait_time_sec):
-        time.sleep(1)
-        if not pid_file.is_file():
-            # PID file cleaned up, process finished
+    except (ValueError, IOError):
+        # Corrupted or not readable PID file, fall back to waiting for the file to disappear
+        pass
+    else:
+        exited = wait_for_process_exit(pid, wait_time_sec)
+        if exited is not None:
+            if not exited:
+                print("ERROR: Timeout waiting for previous command to finish.")
+                return False
+            # The process removes its PID file on exit; remove a stale one left behind
+            with suppress(FileNotFoundError):
+                os.unlink(pid_file)
             return True
+
+    deadline = time.monotonic() + wait_time_sec
+    delay = 0.001
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
         # Check for stale PID file
         try:
-            pid: int = int(pid_file.read_text())
+            pid: int = read_pid_file(pid_file)
+        except FileNotFoundError:
+            # PID file cleaned up, process finished
+            return True
         except (ValueError, IOError):
             # Corrupted or not readable PID file
             # Try to remove it anyway
             with suppress(IOError):
-                pid_file.unlink()
+                os.unlink(pid_file)
             return False
         else:
             if not pid_exists(pid):
                 # Stale PID file, remove it
-                pid_file.unlink()
+                os.unlink(pid_file)
                 return True
     else:
         print("ERROR: Timeout waiting for previous command to finish.")
         return False
 
 
-def send_text_to_stdout(text_file: Path) -> bool:
+def sendfile_to_stdout(f) -> None:
+    """
+    Copy the rest of the open file f to stdout in kernel, without copying the data through a Python buffer.
+
+    Uses os.splice() when stdout is a pipe, the data then goes straight from the page cache to the pipe,
+    os.sendfile() otherwise.
+
+    Raise OSError if neither is supported for stdout. The file position is left after the data sent.
+    """
+    in_fd = f.fileno()
+    out_fd = sys.stdout.fileno()
+    offset = f.tell()
+    size = os.fstat(in_fd).st_size
+    use_splice = hasattr(os, "splice") and stat.S_ISFIFO(os.fstat(out_fd).st_mode)
+    try:
+        while offset < size:
+            if use_splice:
+                sent = os.splice(in_fd, out_fd, size - offset, offset_src=offset)
+            else:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+            if not sent:
+                break
+            offset += sent
+    finally:
+        # Let a fallback continue where this stopped
+        f.seek(offset)
+
+
+def mmap_to_stdout(f) -> bool:
+    """
+    Write the rest of the open file f to stdout straight from a read-only memory map, so that
+    the kernel copies the data from the page cache without an intermediate Python buffer.
+
+    Small files are not mapped, mmap() setup costs more than it saves there.
+
+    :returns: Return True if the file has been written, False if it is too small to be mapped.
+        The file position is left after the data written.
+    """
+    size = os.fstat(f.fileno()).st_size
+    pos = f.tell()
+    if size - pos < MMAP_MIN_SIZE:
+        return False
+    out_fd = sys.stdout.fileno()
+    try:
+        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                # write() may be partial, e.g. on pipes or for more than INT_MAX bytes
+                while pos < size:
+                    # Release each slice right away, the map cannot be closed while one is alive
+                    with view[pos:] as rest:
+                        pos += os.write(out_fd, rest)
+    finally:
+        # Let a fallback continue where this stopped
+        f.seek(pos)
+    return True
+
+
+def open_for_replay(path: str) -> int:
+    """
+    Open the cache file for reading without updating its access time, a replay must not dirty the inode.
+
+    O_NOATIME is only allowed to the file owner (EPERM otherwise), the file is then opened without it.
+
+    :return: File descriptor
+    """
+    flags = os.O_RDONLY | os.O_CLOEXEC
+    noatime = getattr(os, "O_NOATIME", 0)
+    if noatime:
+        try:
+            return os.open(path, flags | noatime)
+        except PermissionError:
+            pass
+    return os.open(path, flags)
+
+
+def send_text_to_stdout(text_file: Union[str, int]) -> bool:
     """
     Send text file to stdout.
 
@@ -211,14 +644,36 @@ def send_text_to_stdout(text_file: Path) -> bool:
     See for more details:
     https://docs.python.org/3/library/signal.html#note-on-sigpipe
 
-    :param text_file:
+    :param text_file: Path or open descriptor of the file, the descriptor is closed afterwards
     :return: Return True on complete output, False on BrokenPipeError
     """
     try:
         # Output cached data
         # Open in binary mode and copy to stdout buffer directly to avoid unnecessary decoding/encoding
-        with text_file.open('rb') as f:
-            copyfileobj(f, sys.stdout.buffer)
+        fd = text_file if isinstance(text_file, int) else open_for_replay(text_file)
+        with open(fd, 'rb') as f:
+            if hasattr(os, "posix_fadvise"):
+                # The whole file is read once from start to end, let the kernel read ahead aggressively
+                # and not promote its pages as frequently used
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_NOREUSE)
+            # Anything already written to sys.stdout must precede the data written to its descriptor
+            sys.stdout.flush()
+            try:
+                sendfile_to_stdout(f)
+            except BrokenPipeError:
+                raise
+            except (OSError, AttributeError, ValueError):
+                # sendfile() not available for this stdout (EINVAL/ENOTSUP), or stdout has no descriptor
+                try:
+                    copied = mmap_to_stdout(f)
+                except BrokenPipeError:
+                    raise
+                except (OSError, ValueError):
+                    copied = False
+                if not copied:
+                    from shutil import copyfileobj
+                    copyfileobj(f, sys.stdout.buffer)
         # Flush output here to force SIGPIPE to be triggered while inside this try block.
         sys.stdout.flush()
         return True
@@ -233,42 +688,169 @@ def send_text_to_stdout(text_file: Path) -> bool:
         return False
 
 
-def create_pid_file(command: Iterable[str]) -> Optional[Path]:
+def create_pid_file(paths: CachePaths) -> Optional[str]:
     """
-    Create PID file for given command.
+    Create PID file for the command.
 
     If there is a process with the same command already runhing, wait for its completion.
 
     Return None on timeout waiting for already running process.
 
-    :param command:
+    :param paths: Cache file paths of the command
     :return: PID if PID file has been successfully created or None if there was a timeout waiting for already running process
     """
-    cache_dir = get_cache_dir()
-    command_hash = generate_command_hash(command)
-    pid_file = Path(cache_dir, f"{command_hash}.pid")
-
-    # Random sleep
-    if MAX_RAND_SEC - MIN_RAND_SEC > 0:
-        time.sleep(random.uniform(MIN_RAND_SEC, MAX_RAND_SEC))
+    pid_file = paths.pid
 
     # Avoid parallel execution
     if not wait_for_previous_command(pid_file, MAX_WAIT_PREV_SEC):
         return None
 
     # Create a PID file
-    with pid_file.open('w') as f:
+    with open(pid_file, 'w') as f:
         f.write(str(os.getpid()))
 
     return pid_file
 
 
-def main():
+def acquire_command_lock(paths: CachePaths, wait_time_sec: int) -> Optional[int]:
     """
-    Run command and cache its output. Return cached output if cache not expired.
+    Lock the command with flock() on its persistent <hash>.lock file.
+
+    If there is a process with the same command already running, wait for its completion, at most
+    wait_time_sec seconds. The kernel wakes us up as soon as the lock is released and releases it
+    itself when the holder dies, so there are no stale locks to detect.
+
+    Raise OSError if flock() is not supported (e.g. ENOLCK or EOPNOTSUPP on some filesystems).
+
+    :param paths: Cache file paths of the command
+    :return: Descriptor of the locked file (closing it releases the lock) or None on timeout
+    """
+    fd = os.open(paths.lock, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except BlockingIOError:
+        pass
+    except BaseException:
+        os.close(fd)
+        raise
+
+    import signal
+
+    def on_timeout(signum, frame):
+        raise TimeoutError()
+
+    # Blocking flock() with the wait bounded by SIGALRM
+    acquired = False
+    previous_handler = signal.signal(signal.SIGALRM, on_timeout)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, wait_time_sec)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            acquired = True
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except TimeoutError:
+        # Timer could also fire right after the lock has been acquired
+        pass
+    except BaseException:
+        os.close(fd)
+        raise
+    finally:
+        signal.signal(signal.SIGALRM, previous_handler)
+
+    if not acquired:
+        os.close(fd)
+        return None
+    return fd
+
+
+def try_cached(paths: CachePaths, cache_timeout: float) -> Optional[Tuple[int, int]]:
+    """
+    Look up a valid cached result of the command.
+
+    The output cache is opened first and checked with fstat(), so the freshness check and the replay
+    see the same file even if it is being replaced meanwhile.
+
+    :return: Descriptor of the open output cache (the caller closes it) and the command return code
+        on cache hit, None on cache miss
+    """
+    try:
+        fd = open_for_replay(paths.data)
+    except FileNotFoundError:
+        return None
+    try:
+        st = os.fstat(fd)
+        # Age taken in integer nanoseconds, so that sub-second timeouts are not lost in float rounding of
+        # the epoch times; compared as float, the timeout may be inf or too large for nanoseconds
+        if stat.S_ISREG(st.st_mode) and (time.time_ns() - st.st_mtime_ns) / 1e9 <= cache_timeout:
+            return fd, read_exit_code(fd, paths.exit)
+    except (ValueError, IOError):
+        # Exit code not available, execute the command again
+        pass
+    os.close(fd)
+    return None
+
+
+def parse_args_fast(argv: Sequence[str]) -> Optional[SimpleNamespace]:
+    """
+    Parse the common command line shapes without argparse, which is costly to import and set up
+    compared to serving a cached result.
+
+    :return: Parsed arguments like parse_args() or None if argparse is needed (help, unknown option, error)
+    """
+    args = SimpleNamespace(command=None, command_args=[], cache_timeout=None,
+                           cache_on_error=False, cache_on_abort=False, verbose=False)
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--" and i + 1 < len(argv):
+            # Everything after "--" is the command, even if it starts with "-"
+            args.command = argv[i + 1]
+            args.command_args = list(argv[i + 2:])
+            return args
+        if not arg.startswith("-") or arg == "-":
+            args.command = arg
+            args.command_args = list(argv[i + 1:])
+            # Like argparse, drop the first "--" also when it comes right after the command
+            if args.command_args[:1] == ["--"]:
+                del args.command_args[0]
+            return args
+        if arg in ("-e", "--cache-on-error"):
+            args.cache_on_error = True
+        elif arg in ("-a", "--cache-on-abort"):
+            args.cache_on_abort = True
+        elif arg in ("-v", "--verbose"):
+            args.verbose = True
+        elif arg in ("-c", "--cache-timeout") or arg.startswith(("--cache-timeout=", "-c")):
+            if arg.startswith("--cache-timeout="):
+                value = arg.partition("=")[2]
+            elif arg.startswith("-c") and len(arg) > 2:
+                value = arg[2:]
+            elif i + 1 < len(argv):
+                i += 1
+                value = argv[i]
+            else:
+                return None
+            try:
+                args.cache_timeout = float(value)
+            except ValueError:
+                return None
+        else:
+            # Help, combined short options etc.
+            return None
+        i += 1
+    # No command given
+    return None
+
+
+def parse_args(argv: Sequence[str], description: Optional[str] = None):
     """
+    Parse the command line with argparse.
+    """
+    import argparse
 
-    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument("command", metavar="command ...", help="Command with arguments")
     parser.add_argument("-c", "--cache-timeout", type=float,
                         help=f"Cache timeout in seconds (float), default is {DEFAULT_CACHE_TIMEOUT_SEC}s")
@@ -279,49 +861,84 @@ def main():
     parser.add_argument("-v", "--verbose", default=False, action="store_true",
                         help="Print diagnostic information")
     parser.add_argument('command_args', help=argparse.SUPPRESS, nargs=argparse.REMAINDER)
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
+
+def main():
+    """
+    Run command and cache its output. Return cached output if cache not expired.
+    """
+
+    args = parse_args_fast(sys.argv[1:])
+    if args is None:
+        args = parse_args(sys.argv[1:], description=main.__doc__)
 
     command = [args.command] + args.command_args
     cache_timeout = max(0.0, args.cache_timeout if args.cache_timeout is not None else DEFAULT_CACHE_TIMEOUT_SEC)
 
-    pid_file: Path = create_pid_file(command)
-    # Timeout waiting for already running process
+    command_hash = generate_command_hash(command)
+    paths = build_cache_paths(command_hash)
+
+    # Fast path: serve a valid cache without the lock and CommandCache setup.
+    # No need to serialize with other instances, the cache file is published only once complete.
+    hit = try_cached(paths, cache_timeout)
+    if hit is not None:
+        cache_fd, return_code = hit
+        if args.verbose:
+            print("DIAG: Returning cached result")
+        send_text_to_stdout(cache_fd)
+        if return_code != 0 and not args.cache_on_error:
+            with suppress(IOError):
+                if args.verbose:
+                    print("DIAG: Destroying output cache (RC)")
+                os.unlink(paths.data)
+        sys.exit(return_code)
+
+    # Random sleep
+    if MAX_RAND_SEC - MIN_RAND_SEC > 0:
+        import random
+        time.sleep(random.uniform(MIN_RAND_SEC, MAX_RAND_SEC))
+
+    # Avoid parallel execution
+    lock_fd: Optional[int] = None
+    pid_file: Optional[str] = None
     try:
+        lock_fd = acquire_command_lock(paths, MAX_WAIT_PREV_SEC)
+    except OSError:
+        # Locking not supported here, fall back to the PID file
+        # The PID file holds our own PID once created, no need to read it back
+        try:
+            pid_file = create_pid_file(paths)
+        except IOError as e:
+            print(f"ERROR: Creating PID file failed: {repr(e)}")
+            sys.exit(2)
+        # Timeout waiting for already running process
         if pid_file is None:
             print(f"ERROR: Process for given command still running: timeout ({MAX_WAIT_PREV_SEC}")
             sys.exit(2)
-        if os.getpid() != int(pid_file.read_text()):
-            print(f"ERROR: Creating PID file failed: Current process PID does not equal PID in the file.")
+    else:
+        # Timeout waiting for already running process
+        if lock_fd is None:
+            print(f"ERROR: Process for given command still running: timeout ({MAX_WAIT_PREV_SEC}")
             sys.exit(2)
-    except ValueError as e:
-        print(f"ERROR: Creating PID file failed: {repr(e)}")
-        sys.exit(2)
-    except IOError as e:
-        print(f"ERROR: Creating PID file failed: {repr(e)}")
-        sys.exit(2)
 
     try:
-        cache = CommandCache(command, cache_timeout=cache_timeout)
-
-        # Execute and cache the result
-        # Output cache file encoding must be the same as sys.stdout encoding
-        cache_file_encoding = sys.stdout.encoding
-        if not cache_file_encoding:
-            cache_file_encoding = "utf-8"
+        cache = CommandCache(command, cache_timeout=cache_timeout, command_hash=command_hash, verbose=args.verbose,
+                             paths=paths)
 
-        # If cache is still valid, return cached result
-        if cache.is_valid(cache_timeout):
+        # If cache is still valid (a previous instance cached the result while we were waiting), return cached result
+        hit = try_cached(paths, cache_timeout)
+        if hit is not None:
             if args.verbose:
                 print("DIAG: Returning cached result")
-            stdout_ok = send_text_to_stdout(cache.output_cache)
+            stdout_ok = send_text_to_stdout(hit[0])
             # TODO: (pavel) 13/12/2024 Provide correct value
-            return_code = int(cache.exit_file.read_text())
+            return_code = hit[1]
         else:
             # Check cache and execute the command if needed
             if args.verbose:
                 print("DIAG: Executing command")
-            executor = execute_command(command, output_cache_file_encoding=cache_file_encoding)
-            return_code = cache.cache_result(executor)
+            return_code = cache.cache_result(cache_on_error=args.cache_on_error, cache_on_abort=args.cache_on_abort)
 
         if return_code !=0 and not args.cache_on_error:
             with suppress(IOError):
@@ -348,9 +965,12 @@ def main():
                 cache.invalidate()
             raise
     finally:
-        # Cleanup the PID file
-        if pid_file.is_file():
-            pid_file.unlink()
+        # Release the lock or cleanup the PID file
+        if lock_fd is not None:
+            os.close(lock_fd)
+        if pid_file is not None:
+            with suppress(FileNotFoundError):
+                os.unlink(pid_file)
 
 
 if __name__ == "__main__":